@@ -1,15 +1,300 @@
+import hashlib
+import http.cookiejar
 import logging
 import os
-import io
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from operator import methodcaller
 from typing import Any, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
 logger = logging.getLogger(__name__)
 
+# PyMuPDF is imported once at plugin load; support both import names used across environments
+_FITZ_IMPORT_ERROR: Optional[Exception] = None
+try:
+    import pymupdf as _fitz  # modern name
+except ImportError:
+    try:
+        import fitz as _fitz  # fallback
+    except ImportError as e:
+        _fitz = None
+        _FITZ_IMPORT_ERROR = e
+
+# Plugin invocations are stateless, so MuPDF's resource store is kept small: its size is
+# fixed when PyMuPDF creates its context, so it is trimmed back to this cap between chunks
+# and emptied after each document. This trades repeat-access caching for bounded RSS.
+_STORE_SOFT_LIMIT = 64 * 1024 * 1024
+
+if _fitz is not None:
+    try:
+        # Per-error message formatting is wasted work; problems still surface as exceptions
+        _fitz.TOOLS.mupdf_display_errors(False)
+        _fitz.TOOLS.mupdf_display_warnings(False)
+    except AttributeError:
+        pass
+
+# Optional Rust-core extractor; used for the "fast" text mode when installed
+try:
+    import fastpdf as _fastpdf
+except ImportError:
+    _fastpdf = None
+
+PAGE_BREAK = "\n\n---PAGE BREAK---\n\n"
+_PAGE_BREAK_BYTES = PAGE_BREAK.encode("utf-8")
+
+# Pages probed for a text layer before skipping extraction of a scanned document
+_OCR_PROBE_PAGES = 4
+
+# Input files fetched ahead of the one being extracted; bounds how many PDFs sit in memory at once
+_FILE_WORKERS = 4
+
+# PyMuPDF is not thread-safe: file workers overlap downloads, but MuPDF calls are serialized
+_FITZ_LOCK = threading.Lock()
+
+
+# Shared HTTP session so repeated downloads from the same host reuse connections
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+# The session is shared by every caller, so never store cookies: a Set-Cookie from one user's
+# download must not be replayed on another user's request
+_SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Downloaded bytes keyed by URL (LRU with TTL; signed links expire, so entries are short-lived).
+# Byte budget is kept well under the plugin's 256 MiB memory limit.
+_URL_CACHE: "OrderedDict[str, tuple[float, bytes]]" = OrderedDict()
+_URL_CACHE_LOCK = threading.Lock()
+_URL_CACHE_MAX_ITEMS = 32
+_URL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_URL_CACHE_TTL = 300
+
+
+def _url_cache_get(key: str) -> Optional[bytes]:
+    with _URL_CACHE_LOCK:
+        entry = _URL_CACHE.get(key)
+        if entry is None:
+            return None
+        stored_at, data = entry
+        if time.monotonic() - stored_at > _URL_CACHE_TTL:
+            del _URL_CACHE[key]
+            return None
+        _URL_CACHE.move_to_end(key)
+        return data
+
+
+def _url_cache_put(key: str, data: bytes) -> None:
+    if len(data) > _URL_CACHE_MAX_BYTES:
+        return
+    with _URL_CACHE_LOCK:
+        _URL_CACHE[key] = (time.monotonic(), data)
+        _URL_CACHE.move_to_end(key)
+        total = sum(len(d) for _, d in _URL_CACHE.values())
+        while len(_URL_CACHE) > _URL_CACHE_MAX_ITEMS or total > _URL_CACHE_MAX_BYTES:
+            _, (_, evicted) = _URL_CACHE.popitem(last=False)
+            total -= len(evicted)
+
+
+def _read_body(resp: requests.Response) -> bytes:
+    """
+    Read a streamed response body. When Content-Length is known (and the body is not
+    content-encoded, which would change its size), fill a buffer allocated once up front.
+    """
+    try:
+        clen = int(resp.headers.get("Content-Length") or 0)
+    except ValueError:
+        clen = 0
+    encoding = resp.headers.get("Content-Encoding", "identity").strip().lower()
+
+    if clen > 0 and encoding in ("", "identity"):
+        buf = bytearray(clen)
+        mv = memoryview(buf)
+        off = 0
+        chunks = resp.iter_content(_DOWNLOAD_CHUNK_SIZE)
+        for chunk in chunks:
+            end = off + len(chunk)
+            if end > clen:
+                # Server sent more than advertised; continue with a growable buffer
+                tail = bytearray(mv[:off])
+                del mv
+                tail.extend(chunk)
+                for rest in chunks:
+                    tail.extend(rest)
+                return bytes(tail)
+            mv[off:end] = chunk
+            off = end
+        del mv
+        if off < clen:
+            del buf[off:]
+        return bytes(buf)
+
+    buf = bytearray()
+    for chunk in resp.iter_content(_DOWNLOAD_CHUNK_SIZE):
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _release_mupdf_store() -> None:
+    """
+    Drop MuPDF's global font/image store after a document is closed, so a long-lived
+    plugin worker does not keep growing across documents.
+    """
+    try:
+        _fitz.TOOLS.store_shrink(100)
+    except AttributeError:
+        pass
+
+
+def _bound_mupdf_store() -> None:
+    """
+    Trim MuPDF's store while a document is still open once it grows past the soft limit.
+    """
+    try:
+        if _fitz.TOOLS.store_size > _STORE_SOFT_LIMIT:
+            _fitz.TOOLS.store_shrink(50)
+    except AttributeError:
+        pass
+
+
+def _first(*vals: Optional[str]) -> Optional[str]:
+    for v in vals:
+        if isinstance(v, str) and v.strip():
+            return v.strip()
+    return None
+
+
+def _infer_filename(item: dict, url: Optional[str]) -> str:
+    # Prefer explicit filename if provided
+    name = item.get("filename")
+    if isinstance(name, str) and name.strip():
+        return name.strip()
+
+    # Derive from URL path if available
+    if url:
+        base = url.split("?", 1)[0]  # strip query
+        leaf = os.path.basename(base) or "document.pdf"
+        return leaf
+
+    # Fallback
+    return "document.pdf"
+
+
+_encode_page = methodcaller("encode", "utf-8", "ignore")
+
+
+def _finalize(
+    texts: list[str],
+    filename: str,
+    sep: bytes,
+    build_joined: bool = True,
+    build_json: bool = True,
+    first_page: int = 1,
+    needs_ocr: bool = False,
+) -> tuple[bytes, Optional[list[dict]]]:
+    """
+    Turn extracted page texts into the tool outputs: the joined UTF-8 text and the
+    per-page JSON dicts (numbered from `first_page`). Either side is skipped when not requested.
+    Pages of image-only documents are marked with `needs_ocr` in their metadata.
+    """
+    joined = b""
+    if build_joined:
+        # bytes.join sizes the result once; map() + methodcaller keeps the encode loop in C
+        joined = sep.join(map(_encode_page, texts))
+
+    page_dicts = None
+    if build_json and needs_ocr:
+        page_dicts = [
+            {"text": text, "metadata": {"page": idx, "file_name": filename, "needs_ocr": True}}
+            for idx, text in enumerate(texts, start=first_page)
+        ]
+    elif build_json:
+        page_dicts = [
+            {"text": text, "metadata": {"page": idx, "file_name": filename}}
+            for idx, text in enumerate(texts, start=first_page)
+        ]
+    return joined, page_dicts
+
+
+def _chunked(texts: "list[str] | tuple[str, ...]", size: int) -> Generator[tuple[int, list[str]], None, None]:
+    """
+    Yield (first_page_index, texts) slices of `size` pages; the whole list at once when `size` is 0.
+    """
+    if size <= 0 or len(texts) <= size:
+        yield 0, list(texts)
+        return
+    for start in range(0, len(texts), size):
+        yield start, list(texts[start:start + size])
+
+
+def _texts_size(texts: "list[str] | tuple[str, ...]") -> int:
+    """
+    Memory held by page strings, including per-object overhead (non-ASCII text takes 2-4 bytes
+    per character, so character counts understate it).
+    """
+    return sum(map(sys.getsizeof, texts))
+
+
+def _as_bool(value: Any, default: bool) -> bool:
+    if value is None or value == "":
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() not in ("false", "0", "no", "off", "")
+    return bool(value)
+
+
+def _as_int(value: Any, default: int) -> int:
+    if value is None or value == "":
+        return default
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return default
+
+
+@dataclass(frozen=True)
+class _InvokeOptions:
+    text_flags: Optional[int] = None
+    use_fastpdf: bool = False
+    emit_text: bool = True
+    emit_json: bool = True
+    emit_blob: bool = True
+    chunk_pages: int = 0
+
+
+@dataclass
+class _FetchResult:
+    filename: str
+    pdf_bytes: bytes = b""
+    error: Optional[str] = None
+
+
+def _extract_with_fastpdf(pdf_bytes: bytes, page_count: int) -> list[str]:
+    """
+    Extract per-page texts with fastpdf and reshape its blocks into one string per page.
+    The result has `page_count` entries; pages without blocks come back as "".
+    Raises ValueError if fastpdf reports a page index outside the document.
+    """
+    blocks, _ = _fastpdf.extract_bytes(pdf_bytes, include_images=False, page_parallel=True)
+    parts: list[list[str]] = [[] for _ in range(page_count)]
+    for block in blocks:
+        page = block["page"] if isinstance(block, dict) else block.page
+        text = block["text"] if isinstance(block, dict) else block.text
+        if not 0 <= page < page_count:
+            raise ValueError(f"fastpdf returned page {page} for a {page_count}-page document")
+        parts[page].append(text)
+    return ["\n".join(p) for p in parts]
+
 
 class PymupdfTool(Tool):
     """
@@ -24,42 +309,33 @@ class PymupdfTool(Tool):
           - `filename`, `mime_type`, `size`
     """
 
+    # Extracted page texts keyed by content hash of the PDF bytes (LRU, shared across invocations).
+    # Like the URL cache, it has a byte budget, measured as the memory of the page strings, to stay
+    # within the plugin's memory limit; it lives in process memory only. A document being extracted
+    # is accumulated against the same budget, so the two together stay under twice this size.
+    _page_cache: "OrderedDict[str, tuple[tuple[str, ...], bool]]" = OrderedDict()
+    _page_cache_bytes = 0
+    _PAGE_CACHE_MAX_ITEMS = 64
+    _PAGE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
     # ------------- helpers -------------
 
     @staticmethod
-    def _import_fitz():
+    def _resolve_text_flags(mode: Optional[str]) -> Optional[int]:
         """
-        Support both import names used by PyMuPDF across environments.
+        Map the `text_flags` tool parameter to `page.get_text` flags:
+          - "fast" (default): only clip to the page; skips ligature/whitespace preservation
+          - "dehyphenate": preserve whitespace and join hyphenated line breaks
+          - "default": PyMuPDF's own defaults (highest fidelity, slowest)
         """
-        try:
-            import pymupdf as fitz  # modern name
-            return fitz
-        except Exception:
-            import fitz  # fallback
-            return fitz
-
-    @staticmethod
-    def _first(*vals: Optional[str]) -> Optional[str]:
-        for v in vals:
-            if isinstance(v, str) and v.strip():
-                return v.strip()
-        return None
-
-    @staticmethod
-    def _infer_filename(item: dict, url: Optional[str]) -> str:
-        # Prefer explicit filename if provided
-        name = item.get("filename")
-        if isinstance(name, str) and name.strip():
-            return name.strip()
-
-        # Derive from URL path if available
-        if url:
-            base = url.split("?", 1)[0]  # strip query
-            leaf = os.path.basename(base) or "document.pdf"
-            return leaf
-
-        # Fallback
-        return "document.pdf"
+        mode = (mode or "fast").strip().lower()
+        if mode == "default":
+            return None
+        if mode == "dehyphenate":
+            return _fitz.TEXT_PRESERVE_WHITESPACE | _fitz.TEXT_DEHYPHENATE | _fitz.TEXT_MEDIABOX_CLIP
+        if mode != "fast":
+            logger.warning(f"Unknown text_flags '{mode}', using 'fast'")
+        return _fitz.TEXT_MEDIABOX_CLIP
 
     @staticmethod
     def _ensure_pdf_bytes(item: Any, timeout: int = 30) -> bytes:
@@ -67,6 +343,9 @@ class PymupdfTool(Tool):
         Return PDF bytes from:
           - Dify File (has .blob) or dict with 'blob'
           - dict with 'url' or 'remote_url'
+
+        Downloads are cached briefly by full URL, query string included, so a cached copy
+        is only served to a caller holding the same (e.g. signed) link.
         """
         # Case 1: looks like Dify File with .blob
         blob = getattr(item, "blob", None)
@@ -80,102 +359,325 @@ class PymupdfTool(Tool):
         # Case 3: fetch via URL/remote_url
         url = None
         if isinstance(item, dict):
-            url = PymupdfTool._first(item.get("url"), item.get("remote_url"))
+            url = _first(item.get("url"), item.get("remote_url"))
         if not url or not isinstance(url, str):
             raise ValueError("No usable PDF source found (need 'blob' or absolute 'url'/'remote_url').")
 
-        resp = requests.get(url, timeout=timeout)
-        resp.raise_for_status()
+        cached = _url_cache_get(url)
+        if cached is not None:
+            return cached
 
-        # Optional: quick content-type sanity check (do not hard-fail on misreported servers)
-        ctype = resp.headers.get("Content-Type", "")
-        if "pdf" not in ctype.lower():
-            logger.debug(f"Content-Type not indicating PDF: {ctype} (continuing anyway)")
+        with _SESSION.get(url, timeout=timeout, stream=True) as resp:
+            resp.raise_for_status()
 
-        return resp.content
+            # Optional: quick content-type sanity check (do not hard-fail on misreported servers)
+            ctype = resp.headers.get("Content-Type", "")
+            if "pdf" not in ctype.lower():
+                logger.debug(f"Content-Type not indicating PDF: {ctype} (continuing anyway)")
 
-    @staticmethod
-    def _extract_text_from_pdf_bytes(pdf_bytes: bytes, fitz_module) -> list[dict]:
+            data = _read_body(resp)
+
+        _url_cache_put(url, data)
+        return data
+
+    @classmethod
+    def _iter_page_chunks(
+        cls,
+        pdf_bytes: bytes,
+        flags: Optional[int] = None,
+        use_fastpdf: bool = False,
+        chunk_pages: int = 0,
+    ) -> Generator[tuple[int, list[str], bool], None, None]:
         """
-        Return a list of page dicts: { 'text': str, 'metadata': { 'page': int, 'file_name': str } }
+        Yield (first_page_index, texts, needs_ocr) for consecutive runs of `chunk_pages` pages,
+        or the whole document at once when `chunk_pages` is 0.
+
+        Image-only (scanned) documents are detected by probing a few pages; when every probed page
+        is empty, the pages are returned empty with `needs_ocr` set instead of being run through
+        `get_text` one by one. Documents no longer than the probe are extracted in full before the
+        first chunk is yielded, and flagged when every page comes back empty.
+
+        `flags` is passed to `page.get_text` (None means PyMuPDF's defaults).
+        With `use_fastpdf`, fastpdf is tried first and PyMuPDF is the fallback.
+        Results are cached by content hash and options, so re-uploads of the same PDF skip parsing.
+        Chunked documents are cached once fully extracted, as long as their text fits the cache's
+        byte budget; larger documents are not retained, keeping memory bounded by that budget.
         """
-        pages = []
-        # Use a BytesIO stream for PyMuPDF
-        stream = io.BytesIO(pdf_bytes)
-        doc = None
+        # Results are cached under the backend that actually produced them
+        digest = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+        fastpdf_key = f"{digest}:fastpdf:{flags}"
+        key = f"{digest}:pymupdf:{flags}"
+        try_fastpdf = use_fastpdf and _fastpdf is not None
+
+        with _FITZ_LOCK:
+            for candidate in (fastpdf_key, key) if try_fastpdf else (key,):
+                cached = cls._page_cache.get(candidate)
+                if cached is not None:
+                    cls._page_cache.move_to_end(candidate)
+                    break
+        if cached is not None:
+            texts, needs_ocr = cached
+            for start, chunk in _chunked(texts, chunk_pages):
+                yield start, chunk, needs_ocr
+            return
+
+        # MuPDF calls are serialized per chunk, so the lock is not held while the consumer runs
+        with _FITZ_LOCK:
+            # PyMuPDF accepts raw bytes and copies them into its own buffer
+            doc = _fitz.open(stream=pdf_bytes, filetype="pdf")
         try:
-            doc = fitz_module.open(stream=stream, filetype="pdf")
-            for i in range(doc.page_count):
-                page = doc.load_page(i)
-                text = page.get_text("text")
-                pages.append({"text": text})
+            n = doc.page_count
+            if n == 0:
+                cls._cache_put(key, [])
+                yield 0, [], False
+                return
+
+            if try_fastpdf:
+                texts = None
+                try:
+                    texts = _extract_with_fastpdf(pdf_bytes, n)
+                except Exception as e:
+                    logger.warning(f"fastpdf extraction failed ({e}); falling back to PyMuPDF")
+                if texts is not None and not any(t.strip() for t in texts):
+                    # No text at all (e.g. a scanned PDF); let PyMuPDF and the OCR probe decide
+                    logger.info("fastpdf returned no text; falling back to PyMuPDF")
+                    texts = None
+                if texts is not None:
+                    cls._cache_put(fastpdf_key, texts)
+                    for start, chunk in _chunked(texts, chunk_pages):
+                        yield start, chunk, False
+                    return
+
+            if n <= _OCR_PROBE_PAGES:
+                # Probing would read every page anyway; extract them all so the flag covers each chunk
+                with _FITZ_LOCK:
+                    texts = cls._extract_page_texts(doc, 0, n, flags)
+                    _bound_mupdf_store()
+                needs_ocr = not any(t.strip() for t in texts)
+                cls._cache_put(key, texts, needs_ocr)
+                for start, chunk in _chunked(texts, chunk_pages):
+                    yield start, chunk, needs_ocr
+                return
+
+            with _FITZ_LOCK:
+                first_text = cls._probe_text_layer(doc, flags)
+            if first_text is None:
+                logger.info(f"No text layer found on probed pages; skipping extraction of {n} pages")
+                texts = [""] * n
+                cls._cache_put(key, texts, True)
+                for start, chunk in _chunked(texts, chunk_pages):
+                    yield start, chunk, True
+                return
+
+            step = chunk_pages if 0 < chunk_pages < n else n
+            # Text of the chunks so far, for the page cache; dropped once it outgrows the budget
+            acc: Optional[list[str]] = []
+            acc_bytes = 0
+            for start in range(0, n, step):
+                stop = min(start + step, n)
+                with _FITZ_LOCK:
+                    if start == 0:
+                        # Page 0 was already extracted by the probe
+                        texts = [first_text]
+                        texts += cls._extract_page_texts(doc, 1, stop, flags)
+                    else:
+                        texts = cls._extract_page_texts(doc, start, stop, flags)
+                    _bound_mupdf_store()
+                if acc is not None:
+                    acc_bytes += _texts_size(texts)
+                    if acc_bytes <= cls._PAGE_CACHE_MAX_BYTES:
+                        acc.extend(texts)
+                    else:
+                        acc = None
+                yield start, texts, False
+            if acc is not None:
+                cls._cache_put(key, acc)
         finally:
-            if doc is not None:
+            with _FITZ_LOCK:
                 doc.close()
-            stream.close()
-        return pages
+                _release_mupdf_store()
 
-    # ------------- main entry -------------
+    @staticmethod
+    def _probe_text_layer(doc, flags: Optional[int]) -> Optional[str]:
+        """
+        Probe the first page and, if it has no text, the second, middle and last pages.
+        Returns None when every probed page is empty (an image-only document), otherwise the
+        text of the first page so the caller does not extract it twice.
+        Callers only probe documents longer than `_OCR_PROBE_PAGES`, so skipping saves work.
+        """
+        n = doc.page_count
+        first_text = doc.load_page(0).get_text("text", flags=flags)
+        if first_text.strip():
+            return first_text
+        for i in (1, n // 2, n - 1):
+            if doc.load_page(i).get_text("text", flags=flags).strip():
+                return first_text
+        return None
 
-    def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage, None, None]:
-        files = tool_parameters.get("files")
-        if not files or not isinstance(files, list):
-            yield self.create_text_message("No files provided. Please supply an array of PDF objects or Dify Files.")
+    @classmethod
+    def _cache_put(cls, key: str, texts: list[str], needs_ocr: bool = False) -> None:
+        size = _texts_size(texts)
+        if size > cls._PAGE_CACHE_MAX_BYTES:
             return
+        # Strings are immutable, so the cache can hold them without defensive copies
+        with _FITZ_LOCK:
+            old = cls._page_cache.pop(key, None)
+            if old is not None:
+                cls._page_cache_bytes -= _texts_size(old[0])
+            cls._page_cache[key] = (tuple(texts), needs_ocr)
+            cls._page_cache_bytes += size
+            while (
+                len(cls._page_cache) > cls._PAGE_CACHE_MAX_ITEMS
+                or cls._page_cache_bytes > cls._PAGE_CACHE_MAX_BYTES
+            ):
+                _, (evicted, _) = cls._page_cache.popitem(last=False)
+                cls._page_cache_bytes -= _texts_size(evicted)
 
-        # Import PyMuPDF
+    @staticmethod
+    def _extract_page_texts(doc, start: int, stop: int, flags: Optional[int]) -> list[str]:
+        """
+        Extract pages [start, stop) of an open document. Callers hold the MuPDF lock.
+        """
+        texts = [""] * (stop - start)
+        for i in range(start, stop):
+            texts[i - start] = doc.load_page(i).get_text("text", flags=flags)
+        return texts
+
+    @staticmethod
+    def _error_filename(item: Any) -> str:
+        if isinstance(item, dict):
+            return _infer_filename(item, _first(item.get("url"), item.get("remote_url")))
+        return "unknown.pdf"
+
+    def _fetch_one_item(self, item: Any) -> _FetchResult:
+        """
+        Resolve the filename and PDF bytes of a single input. Runs on a worker thread,
+        so downloads of later files overlap with extraction of earlier ones.
+        """
         try:
-            fitz_module = self._import_fitz()
+            # Resolve URL for logging/filename purposes if present
+            url = None
+            if isinstance(item, dict):
+                url = _first(item.get("url"), item.get("remote_url"))
+            elif hasattr(item, "url"):
+                url = getattr(item, "url")
+
+            filename = _infer_filename(item if isinstance(item, dict) else {}, url)
+            logger.info(f"Processing PDF: {filename}")
+
+            pdf_bytes = self._ensure_pdf_bytes(item)
+            return _FetchResult(filename=filename, pdf_bytes=pdf_bytes)
+
         except Exception as e:
-            msg = f"Error: PyMuPDF library not installed or failed to import. {e}"
-            logger.error(msg)
-            yield self.create_text_message(msg)
-            return
+            logger.exception(f"Error processing file: {e}")
+            return _FetchResult(filename=self._error_filename(item), error=str(e))
 
-        # Process each input
-        for item in files:
-            try:
-                # Resolve URL for logging/filename purposes if present
-                url = None
-                if isinstance(item, dict):
-                    url = self._first(item.get("url"), item.get("remote_url"))
-                elif hasattr(item, "url"):
-                    url = getattr(item, "url")
+    def _iter_fetched(
+        self, ex: ThreadPoolExecutor, files: list
+    ) -> Generator[tuple[Any, _FetchResult], None, None]:
+        """
+        Yield (item, fetch result) in input order, keeping at most `_FILE_WORKERS` fetches
+        in flight so a slow consumer does not cause every input to be downloaded up front.
+        """
+        items = iter(files)
+        pending = deque()
+        for item in items:
+            pending.append((item, ex.submit(self._fetch_one_item, item)))
+            if len(pending) >= _FILE_WORKERS:
+                break
+        while pending:
+            item, fut = pending.popleft()
+            fetched = fut.result()
+            for nxt in items:
+                pending.append((nxt, ex.submit(self._fetch_one_item, nxt)))
+                break
+            yield item, fetched
 
-                filename = self._infer_filename(item if isinstance(item, dict) else {}, url)
-                logger.info(f"Processing PDF: {filename}")
+    def _emit_chunk(
+        self, filename: str, start: int, texts: list[str], opts: _InvokeOptions, needs_ocr: bool = False
+    ) -> Generator[ToolInvokeMessage, None, None]:
+        """
+        Emit the messages for one run of pages. Outputs that are not requested are not built.
+        """
+        joined_bytes, page_dicts = _finalize(
+            texts,
+            filename,
+            _PAGE_BREAK_BYTES,
+            build_joined=opts.emit_text or opts.emit_blob,
+            build_json=opts.emit_json,
+            first_page=start + 1,
+            needs_ocr=needs_ocr,
+        )
 
-                # Get bytes
-                pdf_bytes = self._ensure_pdf_bytes(item)
+        # Later chunks lead with a page break so concatenated text and blobs match the unchunked output
+        if start and (opts.emit_text or opts.emit_blob):
+            joined_bytes = _PAGE_BREAK_BYTES + joined_bytes
 
-                # Extract text (per page)
-                page_dicts = self._extract_text_from_pdf_bytes(pdf_bytes, fitz_module)
+        # 1) Human-readable text
+        if opts.emit_text:
+            yield self.create_text_message(joined_bytes.decode("utf-8", errors="ignore"))
 
-                # Attach metadata and construct outputs
-                for idx, pd in enumerate(page_dicts, start=1):
-                    pd["metadata"] = {"page": idx, "file_name": filename}
+        # 2) Structured JSON
+        if opts.emit_json:
+            yield self.create_json_message({filename: page_dicts})
 
-                # Join for human-readable text stream
-                joined_text = "\n\n---PAGE BREAK---\n\n".join(p["text"] for p in page_dicts)
+        # 3) Raw text blob
+        if opts.emit_blob:
+            yield self.create_blob_message(
+                joined_bytes,
+                meta={"mime_type": "text/plain"},
+            )
 
-                # 1) Human-readable text
-                yield self.create_text_message(joined_text)
+    # ------------- main entry -------------
 
-                # 2) Structured JSON
-                yield self.create_json_message({filename: page_dicts})
+    def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage, None, None]:
+        files = tool_parameters.get("files")
+        if not files or not isinstance(files, list):
+            yield self.create_text_message("No files provided. Please supply an array of PDF objects or Dify Files.")
+            return
 
-                # 3) Raw text blob
-                yield self.create_blob_message(
-                    joined_text.encode("utf-8", errors="ignore"),
-                    meta={"mime_type": "text/plain"},
-                )
+        if _fitz is None:
+            msg = f"Error: PyMuPDF library not installed or failed to import. {_FITZ_IMPORT_ERROR}"
+            logger.error(msg)
+            yield self.create_text_message(msg)
+            return
+
+        text_mode = (tool_parameters.get("text_flags") or "fast").strip().lower()
+        opts = _InvokeOptions(
+            text_flags=self._resolve_text_flags(text_mode),
+            # fastpdf has no equivalent of the fidelity flags, so it only backs the "fast" mode
+            use_fastpdf=_fastpdf is not None and text_mode == "fast",
+            emit_text=_as_bool(tool_parameters.get("emit_text"), True),
+            emit_json=_as_bool(tool_parameters.get("emit_json"), True),
+            emit_blob=_as_bool(tool_parameters.get("emit_blob"), True),
+            chunk_pages=_as_int(tool_parameters.get("chunk_pages"), 100),
+        )
+
+        # Fetch a bounded window of inputs concurrently, in input order. Extraction streams one
+        # chunk of pages at a time, so messages go out before the whole document is parsed.
+        ex = ThreadPoolExecutor(max_workers=min(_FILE_WORKERS, len(files)))
+        try:
+            for item, fetched in self._iter_fetched(ex, files):
+                error = fetched.error
+                filename = fetched.filename
+                if error is None:
+                    try:
+                        for start, texts, needs_ocr in self._iter_page_chunks(
+                            fetched.pdf_bytes,
+                            opts.text_flags,
+                            opts.use_fastpdf,
+                            opts.chunk_pages,
+                        ):
+                            yield from self._emit_chunk(filename, start, texts, opts, needs_ocr)
+                        continue
+                    except Exception as e:
+                        logger.exception(f"Error processing file: {e}")
+                        error = str(e)
+                        filename = self._error_filename(item)
 
-            except Exception as e:
-                err = f"Error processing file: {e}"
-                logger.exception(err)
                 # Emit helpful error info for both text and JSON channels
-                yield self.create_text_message(err)
-                fname = "unknown.pdf"
-                if isinstance(item, dict):
-                    fname = self._infer_filename(item, self._first(item.get("url"), item.get("remote_url")))
-                yield self.create_json_message({fname: {"error": str(e)}})
+                yield self.create_text_message(f"Error processing file: {error}")
+                yield self.create_json_message({filename: {"error": error}})
+        finally:
+            # Do not wait for queued downloads if the consumer stopped early
+            ex.shutdown(wait=False, cancel_futures=True)